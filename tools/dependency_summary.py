@@ -4,21 +4,30 @@
 #
 #    $> python3 dependency_summary.py --package <package name>
 #
-# It shells out to `cargo metadata` to gather information about the full dependency tree
-# and to `cargo build --build-plan` to figure out the dependencies of the specific target package.
+# It shells out to `cargo metadata` to gather information about the full dependency tree,
+# and walks the resolved dependency graph to figure out the dependencies of the specific target package.
 
 import io
+import mmap
 import re
 import sys
 import os.path
-import argparse
 import subprocess
 import hashlib
 import json
+import time
+import tempfile
 import textwrap
-import itertools
+import functools
 import collections
-import requests
+import concurrent.futures
+
+try:
+    # If available, `orjson` is much faster than the builtin `json` module at parsing
+    # the (large) output of `cargo metadata`, and at serializing our own JSON output.
+    import orjson
+except ImportError:
+    orjson = None
 
 # The targets used by rust-android-gradle, including the ones for unit testing.
 # https://github.com/mozilla/rust-android-gradle/blob/master/plugin/src/main/kotlin/com/nishtahir/RustAndroidPlugin.kt
@@ -49,6 +58,31 @@ ALL_IOS_TARGETS = ["fake-target-for-ios"] if sys.platform != "darwin" else [
 
 ALL_TARGETS = ALL_ANDROID_TARGETS + ALL_IOS_TARGETS
 
+# The maximum number of license files to download from the network concurrently.
+MAX_CONCURRENT_DOWNLOADS = 32
+
+# A header line at the start of generated dependency summaries, recording a fingerprint of
+# the inputs from which they were generated. It's a HTML comment so that it doesn't show up
+# in the rendered markdown.
+FINGERPRINT_HEADER = "<!-- dependency-summary-fingerprint: {} -->"
+FINGERPRINT_HEADER_RE = re.compile(r"^<!-- dependency-summary-fingerprint: ([0-9a-f]+) -->\n?$")
+
+# The contents of a `.sha256` sidecar file, as written by `sha256sum`: a hex digest, optionally followed
+# by the name of the file. See `HashCompareWriter`.
+SHA256_SIDECAR_RE = re.compile(r"^([0-9a-fA-F]{64})(\s.*)?$", re.DOTALL)
+
+# Where to cache things between runs, such as the output of `cargo metadata`.
+# This is relative to the root of the workspace (or to the current directory, if we can't find one).
+CACHE_DIR = os.path.join("target", "dependency_summary_cache")
+
+# Where to cache downloaded license files between runs (again relative to the workspace root), and for
+# how long (in seconds) to trust a cached copy before checking back with the server to see if it has changed.
+LICENSE_CACHE_DIR = os.path.join(CACHE_DIR, "licenses")
+LICENSE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+# We give up on license file downloads that take longer than this many seconds.
+HTTP_REQUEST_TIMEOUT = 10
+
 # The licenses under which we can compatibly use dependencies,
 # in the order in which we prefer them.
 LICENES_IN_PREFERENCE_ORDER = [
@@ -73,6 +107,15 @@ LICENES_IN_PREFERENCE_ORDER = [
     "EXT-ZLIB",
 ]
 
+# The position of each license in the above list, for sorting.
+LICENSE_PREFERENCE_RANK = {license: i for i, license in enumerate(LICENES_IN_PREFERENCE_ORDER)}
+
+# Separators between alternatives in SPDX-style license identifiers, e.g. "MIT/Apache-2.0" or "MIT OR Apache-2.0".
+LICENSE_SPLIT_RE = re.compile(r"\s*(?:/|\sOR\s)\s*")
+
+# Runs of whitespace, which we ignore when comparing license texts.
+WHITESPACE_RE = re.compile(r"\s+")
+
 # Packages that get pulled into our dependency tree but we know we definitely don't
 # ever build with in practice, typically because they're platform-specific support
 # for platforms we don't actually support.
@@ -176,7 +219,7 @@ PACKAGES_WITH_EXTRA_DEPENDENCIES = {
     # in order to reflect accurate license information.
     "rc_crypto": ["ext-ring"],
     # As a special case, we know that the "logins" crate is the only thing that enables SQLCipher.
-    # In a future iteration we could check the cargo build-plan output to see whether anything is
+    # In a future iteration we could check the resolved features to see whether anything is
     # enabling the sqlcipher feature, but this will do for now.
     "logins": ["ext-sqlcipher"],
 }
@@ -447,21 +490,243 @@ COMMON_LICENSE_FILE_NAME_ROOTS = {
 COMMON_LICENSE_FILE_NAME_SUFFIXES = ["", ".md", ".txt"]
 COMMON_LICENSE_FILE_NAMES = {}
 for license in COMMON_LICENSE_FILE_NAME_ROOTS:
-    COMMON_LICENSE_FILE_NAMES[license] = set()
+    names = set()
     for suffix in COMMON_LICENSE_FILE_NAME_SUFFIXES:
         for root in COMMON_LICENSE_FILE_NAME_ROOTS[license]:
-            COMMON_LICENSE_FILE_NAMES[license].add(root + suffix)
+            names.add(root + suffix)
         for root in COMMON_LICENSE_FILE_NAME_ROOTS[""]:
-            COMMON_LICENSE_FILE_NAMES[license].add(root + suffix)
+            names.add(root + suffix)
+    COMMON_LICENSE_FILE_NAMES[license] = frozenset(names)
+
+
+def get_workspace_metadata(workspaceFingerprint=None):
+    """Get metadata for all dependencies in the workspace.
+
+    Running `cargo metadata` takes a couple of seconds, so we cache its output under `CACHE_DIR`,
+    keyed by a fingerprint of the workspace's lockfile and manifests. Callers that have already
+    computed that fingerprint can pass it in, to save computing it again. If we can't find the
+    workspace's lockfile then we don't use the cache, and leave it to cargo to report any problems.
+    """
+    workspaceRoot = get_workspace_root()
+    cachePath = None
+    if workspaceRoot is not None:
+        if workspaceFingerprint is None:
+            workspaceFingerprint = get_workspace_fingerprint(workspaceRoot)
+        # The metadata contains absolute paths to both the workspace and to the sources of
+        # dependencies in cargo's registry, so the location of each is part of the key.
+        cacheKey = hashlib.sha256()
+        cacheKey.update(workspaceRoot.encode("utf8") + b"\0")
+        cacheKey.update(get_cargo_home().encode("utf8") + b"\0")
+        cacheKey.update(get_cargo_version().encode("utf8") + b"\0")
+        cacheKey.update(workspaceFingerprint.encode("utf8"))
+        cachePath = os.path.join(
+            workspaceRoot, CACHE_DIR, "metadata-{}.json".format(cacheKey.hexdigest()))
+    output = None
+    if cachePath is not None:
+        try:
+            with open(cachePath, "rb") as f:
+                output = f.read()
+        except FileNotFoundError:
+            pass
+    if output is None:
+        cmd = ['cargo', '+nightly', 'metadata', '--locked', '--format-version', '1']
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as p:
+            output = p.stdout.read()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+        if cachePath is not None:
+            _write_file_atomically(cachePath, output)
+            _remove_stale_metadata_cache_files(cachePath)
+    # The raw output can be many megabytes, so don't hold on to it
+    # for any longer than it takes to parse it.
+    metadata = parse_json(output)
+    del output
+    return WorkspaceMetadata(metadata)
+
+
+def _remove_stale_metadata_cache_files(cachePath):
+    """Remove cached `cargo metadata` output other than that at the given path.
+
+    Each is several megabytes, and once the workspace has changed we're unlikely to need an old one again.
+    """
+    cacheDir, cacheName = os.path.split(cachePath)
+    for nm in os.listdir(cacheDir):
+        if nm != cacheName and nm.startswith("metadata-") and nm.endswith(".json"):
+            try:
+                os.remove(os.path.join(cacheDir, nm))
+            except FileNotFoundError:
+                # Another run got there first.
+                pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_workspace_root():
+    """Find the root directory of the workspace that contains the current directory.
+
+    Like cargo, this lets us be run from anywhere inside the workspace. The root is the nearest
+    enclosing directory with a `Cargo.lock`, or None if there isn't one.
+    """
+    path = os.path.abspath(os.curdir)
+    while not os.path.isfile(os.path.join(path, "Cargo.lock")):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    return path
+
+
+def get_cargo_home():
+    """Get the directory in which cargo keeps its registry of downloaded dependencies."""
+    cargoHome = os.environ.get("CARGO_HOME") or os.path.join(os.path.expanduser("~"), ".cargo")
+    return os.path.abspath(cargoHome)
 
 
-def get_workspace_metadata():
-    """Get metadata for all dependencies in the workspace."""
-    p = subprocess.run([
-        'cargo', '+nightly', 'metadata', '--locked', '--format-version', '1'
-    ], stdout=subprocess.PIPE, universal_newlines=True)
+def get_cargo_version():
+    """Get the full version string of the cargo toolchain that we use."""
+    p = subprocess.run(['cargo', '+nightly', '--version'],
+                       stdout=subprocess.PIPE, universal_newlines=True)
     p.check_returncode()
-    return WorkspaceMetadata(json.loads(p.stdout))
+    return p.stdout.strip()
+
+
+@functools.lru_cache(maxsize=None)
+def get_rustc_version_info():
+    """Get the verbose version info of the rustc toolchain that we use, as printed by `rustc -vV`.
+
+    This includes both the exact version of the compiler and the target triple of the host.
+    """
+    p = subprocess.run(['rustc', '+nightly', '-vV'],
+                       stdout=subprocess.PIPE, universal_newlines=True)
+    p.check_returncode()
+    return p.stdout
+
+
+def get_workspace_fingerprint(workspaceRoot):
+    """Get a hash of the lockfile and all the manifests in the workspace rooted at the given directory.
+
+    This will change whenever something happens that might change the dependency tree of the workspace,
+    and so can be used to tell when the output of `cargo metadata` needs to be recomputed. Paths are
+    hashed relative to the workspace root, so that this doesn't depend on where the workspace lives.
+    """
+    paths = ["Cargo.lock"]
+    for dirpath, dirnames, filenames in os.walk(workspaceRoot):
+        # Don't descend into build output, or other places where stray manifests might live.
+        dirnames[:] = sorted(nm for nm in dirnames
+                             if nm not in ("target", "node_modules") and not nm.startswith("."))
+        if "Cargo.toml" in filenames:
+            paths.append(os.path.relpath(os.path.join(dirpath, "Cargo.toml"), workspaceRoot))
+    hasher = hashlib.sha256()
+    for path in paths:
+        hasher.update(path.encode("utf8") + b"\0")
+        with open(os.path.join(workspaceRoot, path), "rb") as f:
+            hasher.update(hashlib.sha256(f.read()).digest())
+    return hasher.hexdigest()
+
+
+def get_summary_fingerprint(workspaceFingerprint, packages, targets=None):
+    """Get a hash of all the inputs that determine the dependency summary for the given packages and targets.
+
+    This covers the workspace's lockfile and manifests (via `workspaceFingerprint`, as returned by
+    `get_workspace_fingerprint`), this script itself (which includes things like `PACKAGE_METADATA_FIXUPS`),
+    the requested packages and targets, and the rustc toolchain. The latter matters because we evaluate
+    platform-specific dependencies using the `cfg` values that rustc reports for each target, and those of
+    build-dependencies and proc-macros against the host, which differs from machine to machine.
+    It doesn't cover license files fetched from the network, which we assume to change rarely enough
+    not to matter.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(workspaceFingerprint.encode("utf8"))
+    hasher.update(get_rustc_version_info().encode("utf8"))
+    with open(__file__, "rb") as f:
+        hasher.update(hashlib.sha256(f.read()).digest())
+    hasher.update(json.dumps(
+        [sorted(packages), sorted(targets or ALL_TARGETS)]).encode("utf8"))
+    return hasher.hexdigest()
+
+
+def read_fingerprint_header(path):
+    """Read the fingerprint from the header of a previously-generated dependency summary, if it has one."""
+    try:
+        with open(path, "r") as f:
+            m = FINGERPRINT_HEADER_RE.match(f.readline())
+    except FileNotFoundError:
+        # When checking against a `.sha256` sidecar, the summary itself need not be present.
+        return None
+    if m is None:
+        return None
+    return m.group(1)
+
+
+def parse_json(data):
+    """Parse JSON from the given bytes, using `orjson` if it's available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def serialize_json(obj):
+    """Serialize the given object as compact UTF-8 encoded JSON, using `orjson` if it's available.
+
+    The builtin `json` module is configured to produce exactly the same output as `orjson`,
+    so that the output doesn't depend on which one happens to be installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf8")
+
+
+class PackageInfo(object):
+    """The subset of a package's metadata that we need in order to summarize its licensing.
+
+    Packages that are managed outside of cargo have no `manifest_path` or `source`, and may
+    specify their `license_text` directly rather than via a `license_file`.
+    """
+
+    __slots__ = (
+        "id",
+        "name",
+        "manifest_path",
+        "source",
+        "repository",
+        "license",
+        "license_file",
+        "license_text",
+        "target_kinds",
+        "dependencies",
+        "features",
+    )
+
+    def __init__(self, id, name, manifest_path=None, source=None, repository=None,
+                 license=None, license_file=None, license_text=None, target_kinds=frozenset(),
+                 dependencies=(), features=None):
+        self.id = id
+        self.name = name
+        self.manifest_path = manifest_path
+        self.source = source
+        self.repository = repository
+        self.license = license
+        self.license_file = license_file
+        self.license_text = license_text
+        self.target_kinds = target_kinds
+        self.dependencies = dependencies
+        self.features = features if features is not None else {}
+
+    @classmethod
+    def from_cargo_metadata(cls, info):
+        """Create a `PackageInfo` from an entry in the "packages" list of `cargo metadata`."""
+        return cls(
+            id=info["id"],
+            name=info["name"],
+            manifest_path=info["manifest_path"],
+            source=info["source"],
+            repository=info["repository"],
+            license=info["license"],
+            license_file=info["license_file"],
+            target_kinds=frozenset(
+                kind for target in info["targets"] for kind in target["kind"]),
+            dependencies=info["dependencies"],
+            features=info["features"],
+        )
 
 
 class WorkspaceMetadata(object):
@@ -470,7 +735,8 @@ class WorkspaceMetadata(object):
     This uses `cargo metadata` to load the complete set of package metadata for the dependency tree
     of our workspace.  This typically lists too many packages, because it does a union of all features
     required by all packages in the workspace. Use the `get_package_dependencies` to obtain the
-    set of depdencies for a specific package, based on its build plan.
+    set of depdencies for a specific package, based on the features it enables and the targets
+    it will be compiled for.
 
     For the JSON data format, ref https://doc.rust-lang.org/cargo/commands/cargo-metadata.html
     """
@@ -480,12 +746,22 @@ class WorkspaceMetadata(object):
         self.pkgInfoById = {}
         self.pkgInfoByManifestPath = {}
         self.workspaceMembersByName = {}
+        self.pkgIdsByName = collections.defaultdict(list)
+        self.resolveNodesById = {}
+        # With a trailing separator, so that e.g. "/foo/bar-baz" isn't considered to be inside "/foo/bar".
+        self._workspaceRootPrefix = os.path.join(
+            os.path.normpath(metadata["workspace_root"]), "")
+        self._targetCfgCache = {}
+        self._packageDependenciesCache = {}
+        self._resolvedDependenciesCache = {}
+        self._enabledOptionalDependenciesCache = {}
+        self._hostTarget = None
         for info in metadata["packages"]:
             if info["name"] in EXCLUDED_PACKAGES:
                 continue
             # Apply any hand-rolled fixups, carefully checking that they haven't been invalidated.
-            if info["name"] in PACKAGE_METADATA_FIXUPS:
-                fixups = PACKAGE_METADATA_FIXUPS[info["name"]]
+            fixups = PACKAGE_METADATA_FIXUPS.get(info["name"], None)
+            if fixups is not None:
                 for key, change in fixups.items():
                     if info.get(key, None) != change["check"]:
                         assert False, "Fixup check failed for {}.{}: {} != {}".format(
@@ -493,18 +769,24 @@ class WorkspaceMetadata(object):
                     if "fixup" in change:
                         info[key] = change["fixup"]
             # Index packages for fast lookup.
-            assert info["id"] not in self.pkgInfoById
-            self.pkgInfoById[info["id"]] = info
-            assert info["manifest_path"] not in self.pkgInfoByManifestPath
-            self.pkgInfoByManifestPath[info["manifest_path"]] = info
+            pkgInfo = PackageInfo.from_cargo_metadata(info)
+            if self.pkgInfoById.setdefault(pkgInfo.id, pkgInfo) is not pkgInfo:
+                raise RuntimeError(
+                    "Duplicate package id in cargo metadata: {}".format(pkgInfo.id))
+            if self.pkgInfoByManifestPath.setdefault(pkgInfo.manifest_path, pkgInfo) is not pkgInfo:
+                raise RuntimeError(
+                    "Duplicate manifest path in cargo metadata: {}".format(pkgInfo.manifest_path))
+            self.pkgIdsByName[pkgInfo.name].append(pkgInfo.id)
         # Add fake packages for things managed outside of cargo.
         for name, info in EXTRA_PACKAGE_METADATA.items():
             assert name not in self.pkgInfoById
-            self.pkgInfoById[name] = info.copy()
+            self.pkgInfoById[name] = PackageInfo(id=name, **info)
         for id in metadata["workspace_members"]:
-            name = self.pkgInfoById[id]["name"]
+            name = self.pkgInfoById[id].name
             assert name not in self.workspaceMembersByName
             self.workspaceMembersByName[name] = id
+        for node in metadata["resolve"]["nodes"]:
+            self.resolveNodesById[node["id"]] = node
 
     def has_package(self, id):
         return id in self.pkgInfoById
@@ -515,52 +797,270 @@ class WorkspaceMetadata(object):
     def get_package_by_manifest_path(self, path):
         return self.pkgInfoByManifestPath[path]
 
-    def get_dependency_summary(self, packages, targets=None):
+    def get_dependency_summary(self, packages, targets=None, shareLicenseTexts=False):
         """Get dependency and license summary infomation.
 
         This method will yield dependency summary information for the named package. When the `targets`
         argument is specified it will yield information for the named package when compiled for just
         those targets.
+
+        When `shareLicenseTexts` is true, dependencies whose license has shared text (see
+        `license_has_shared_text`) will all report the same representative copy of that text,
+        which saves reading and downloading a separate copy for each of them. That's appropriate
+        for `print_dependency_summary`, which only ever prints one copy of such texts.
         """
         deps = set()
         for package in packages:
             deps |= self.get_package_dependencies(package, targets)
+        deps = [id for id in deps if self.is_external_dependency(id)]
+        if shareLicenseTexts:
+            sharedLicenseTexts = self.get_shared_license_texts(deps)
+        else:
+            sharedLicenseTexts = {}
+        self._prefetch_remote_licenses(
+            id for id in deps if self.get_license(id) not in sharedLicenseTexts)
         for id in deps:
-            if not self.is_external_dependency(id):
-                continue
-            yield self.get_license_info(id)
+            yield self.get_license_info(id, sharedLicenseTexts)
 
     def get_package_dependencies(self, name, targets=None):
         """Get the set of dependencies for the named package, when compiling for the specified targets.
 
-        This implementation uses `cargo build --build-plan` to list all inputs to the build process.
-        It has the advantage of being guaranteed to correspond to what's included in the actual build,
-        but requires using unstable cargo features.
+        This implementation walks the resolved dependency graph from `cargo metadata`, following only
+        those edges that are enabled for each target, which avoids having to shell out to cargo again
+        for each target. It's intended to match the inputs listed by `cargo build --build-plan`.
         """
         targets = self.get_compatible_targets_for_package(name, targets)
-        cmd = (
-            'cargo', '+nightly', '-Z', 'unstable-options', 'build',
-            '--build-plan',
-            '--quiet',
-            '--locked',
-            '--package', name,
-        )
+        buildTargets = list(dict.fromkeys(
+            "x86_64-apple-darwin" if target == "fake-target-for-ios" else target for target in targets))
+        # Resolving each target is independent, and mostly spent waiting on `rustc` to tell us
+        # about the target's configuration, so we can usefully resolve them concurrently.
+        # The things that are shared between targets are computed up-front.
+        self.get_host_target()
+        self.get_enabled_optional_dependencies(name)
         deps = set()
-        for target in targets:
-            if target == "fake-target-for-ios":
-                target = "x86_64-apple-darwin"
-            args = ('--target', target,)
-            p = subprocess.run(
-                cmd + args, stdout=subprocess.PIPE, universal_newlines=True)
-            p.check_returncode()
-            buildPlan = json.loads(p.stdout)
-            for manifestPath in buildPlan['inputs']:
-                info = self.get_package_by_manifest_path(manifestPath)
-                deps.add(info['id'])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(buildTargets) or 1) as executor:
+            for targetDeps in executor.map(
+                    lambda target: self.get_package_dependencies_for_target(name, target), buildTargets):
+                deps |= targetDeps
         deps |= self.get_extra_dependencies_not_managed_by_cargo(
             name, targets, deps)
         return deps
 
+    def get_package_dependencies_for_target(self, name, target):
+        """Get the set of cargo-managed dependencies for the named package, when compiling for a single target.
+
+        Build scripts and proc-macros are compiled for the host rather than the target, so once we
+        traverse into one of those, we evaluate any further platform-specific dependencies against
+        the host platform. Optional dependencies are only followed if the named package enables them,
+        as determined by `get_enabled_optional_dependencies`.
+
+        The results are memoized, since the same package and target may be requested multiple times
+        (e.g. for both the fake iOS target and the desktop Mac target that it stands in for).
+        """
+        try:
+            return self._packageDependenciesCache[(name, target)]
+        except KeyError:
+            pass
+        host = self.get_host_target()
+        enabledOptionalDeps = self.get_enabled_optional_dependencies(name)
+        root = self.workspaceMembersByName[name]
+        deps = set()
+        seen = set()
+        queue = [(root, target)]
+        while queue:
+            id, platform = queue.pop()
+            if (id, platform) in seen:
+                continue
+            seen.add((id, platform))
+            deps.add(id)
+            if self.is_proc_macro(id):
+                platform = host
+            for decl, depId in self.get_resolved_dependencies(id):
+                if decl["kind"] == "dev":
+                    continue
+                if decl["optional"] and (id, get_dependency_name(decl)) not in enabledOptionalDeps:
+                    continue
+                # Build dependencies are compiled for the host, and so that's the platform
+                # against which any platform-specific build dependencies are evaluated.
+                depPlatform = host if decl["kind"] == "build" else platform
+                if decl["target"] is not None:
+                    if not self.platform_spec_matches(decl["target"], depPlatform):
+                        continue
+                queue.append((depId, depPlatform))
+        deps = frozenset(deps)
+        self._packageDependenciesCache[(name, target)] = deps
+        return deps
+
+    def get_resolved_dependencies(self, id):
+        """Get the dependencies of the given package, as a list of `(declaration, id)` pairs.
+
+        Each declaration is an entry from the package's "dependencies" in `cargo metadata`, and the id
+        is the package that cargo resolved it to. A dependency that's declared more than once, e.g. as
+        both a normal and a dev-dependency, will have an entry for each declaration. Optional dependencies
+        are only included if something in the workspace enables them.
+        """
+        try:
+            return self._resolvedDependenciesCache[id]
+        except KeyError:
+            pass
+        pkgInfo = self.pkgInfoById[id]
+        renames = set(decl["rename"].replace("-", "_")
+                      for decl in pkgInfo.dependencies if decl["rename"] is not None)
+        resolved = []
+        for dep in self.resolveNodesById[id]["deps"]:
+            if not self.has_package(dep["pkg"]):
+                # This is one of our `EXCLUDED_PACKAGES`.
+                continue
+            depPkgName = self.pkgInfoById[dep["pkg"]].name
+            for decl in pkgInfo.dependencies:
+                # The resolve graph identifies dependencies by the name they're imported under, which is
+                # the rename if there is one, and otherwise the name of the dependency's library target.
+                if decl["rename"] is not None:
+                    if decl["rename"].replace("-", "_") != dep["name"]:
+                        continue
+                elif decl["name"] != depPkgName or dep["name"] in renames:
+                    continue
+                if any(depKind["kind"] == decl["kind"] and depKind["target"] == decl["target"]
+                       for depKind in dep["dep_kinds"]):
+                    resolved.append((decl, dep["pkg"]))
+        self._resolvedDependenciesCache[id] = resolved
+        return resolved
+
+    def get_enabled_optional_dependencies(self, name):
+        """Get the optional dependencies that are enabled when building the named package on its own.
+
+        The resolve graph from `cargo metadata` unifies features across the whole workspace, but
+        `cargo build --package` only enables those features requested from within the named package's
+        own dependency tree. This replicates cargo's (version 1) feature resolver to find the optional
+        dependencies that get enabled, as a set of `(id, name)` pairs where `name` is the name under
+        which package `id` declares the dependency.
+
+        Like cargo, this unifies features across all platforms and across normal and build dependencies,
+        and includes features requested by the named package's own dev-dependencies.
+        """
+        try:
+            return self._enabledOptionalDependenciesCache[name]
+        except KeyError:
+            pass
+        root = self.workspaceMembersByName[name]
+        enabledFeatures = set()
+        enabledOptionalDeps = set()
+        # Features requested via "dep/feature" syntax, to apply to the dependency once it's enabled.
+        requestedDepFeatures = collections.defaultdict(set)
+        visited = set()
+        queue = [("visit", root, None), ("feature", root, "default")]
+
+        def is_dependency_enabled(id, decl):
+            return not decl["optional"] or (id, get_dependency_name(decl)) in enabledOptionalDeps
+
+        def request_dependency(id, decl, depId):
+            queue.append(("visit", depId, None))
+            if decl["uses_default_features"]:
+                queue.append(("feature", depId, "default"))
+            for value in decl["features"]:
+                request_feature_value(depId, value)
+            for feature in requestedDepFeatures[(id, get_dependency_name(decl))]:
+                queue.append(("feature", depId, feature))
+
+        def request_feature_value(id, value):
+            # A "feature value" is how cargo names something to enable, both in the features table
+            # and in the features requested by a dependency declaration.
+            if value.startswith("dep:"):
+                queue.append(("dependency", id, value[len("dep:"):]))
+            elif "/" in value:
+                depName, _, depFeature = value.partition("/")
+                # A trailing "?" means to enable the feature only if something
+                # else enables the dependency, rather than enabling it here.
+                if depName.endswith("?"):
+                    depName = depName[:-1]
+                else:
+                    queue.append(("dependency", id, depName))
+                requestedDepFeatures[(id, depName)].add(depFeature)
+                for decl, depId in get_dependencies(id):
+                    if get_dependency_name(decl) == depName and is_dependency_enabled(id, decl):
+                        queue.append(("feature", depId, depFeature))
+            else:
+                queue.append(("feature", id, value))
+
+        def get_dependencies(id):
+            for decl, depId in self.get_resolved_dependencies(id):
+                # Cargo only considers dev-dependencies of the package being built.
+                if decl["kind"] != "dev" or id == root:
+                    yield decl, depId
+
+        while queue:
+            action, id, arg = queue.pop()
+            if action == "visit":
+                if id in visited:
+                    continue
+                visited.add(id)
+                for decl, depId in get_dependencies(id):
+                    if is_dependency_enabled(id, decl):
+                        request_dependency(id, decl, depId)
+            elif action == "feature":
+                if (id, arg) in enabledFeatures:
+                    continue
+                enabledFeatures.add((id, arg))
+                features = self.pkgInfoById[id].features
+                if arg in features:
+                    for value in features[arg]:
+                        request_feature_value(id, value)
+                else:
+                    # Optional dependencies can be enabled as if they were a feature of the same name.
+                    queue.append(("dependency", id, arg))
+            else:
+                assert action == "dependency"
+                if (id, arg) in enabledOptionalDeps:
+                    continue
+                enabledOptionalDeps.add((id, arg))
+                for decl, depId in get_dependencies(id):
+                    if decl["optional"] and get_dependency_name(decl) == arg:
+                        request_dependency(id, decl, depId)
+        enabledOptionalDeps = frozenset(enabledOptionalDeps)
+        self._enabledOptionalDependenciesCache[name] = enabledOptionalDeps
+        return enabledOptionalDeps
+
+    def is_proc_macro(self, id):
+        """Check whether the named package is a proc-macro crate, and hence is compiled for the host."""
+        return "proc-macro" in self.pkgInfoById[id].target_kinds
+
+    def platform_spec_matches(self, spec, target):
+        """Check whether a platform-specific dependency spec from `cargo metadata` applies to the given target.
+
+        The spec may be either the name of a target, or a `cfg(...)` expression.
+        """
+        if not spec.startswith("cfg("):
+            return spec == target
+        return evaluate_cfg_expression(spec[len("cfg("):-1], self.get_target_cfg(target))
+
+    def get_target_cfg(self, target):
+        """Get the set of `cfg` values that are set when compiling for the given target."""
+        try:
+            return self._targetCfgCache[target]
+        except KeyError:
+            pass
+        p = subprocess.run([
+            'rustc', '+nightly', '--print', 'cfg', '--target', target
+        ], stdout=subprocess.PIPE, universal_newlines=True)
+        p.check_returncode()
+        cfg = set()
+        for line in p.stdout.splitlines():
+            key, _, value = line.partition("=")
+            cfg.add((key, value.strip('"')) if value else (key, None))
+        self._targetCfgCache[target] = cfg
+        return cfg
+
+    def get_host_target(self):
+        """Get the target triple of the host platform, for things like build scripts."""
+        if self._hostTarget is None:
+            for line in get_rustc_version_info().splitlines():
+                if line.startswith("host:"):
+                    self._hostTarget = line[len("host:"):].strip()
+                    break
+            else:
+                raise RuntimeError("Could not determine host target from `rustc -vV`")
+        return self._hostTarget
+
     def get_extra_dependencies_not_managed_by_cargo(self, name, targets, deps):
         """Get additional dependencies for things managed outside of cargo.
 
@@ -574,10 +1074,11 @@ class WorkspaceMetadata(object):
                 extras.add("ext-protobuf")
             if self.target_is_ios(target):
                 extras.add("ext-swift-protobuf")
-        for dep in deps:
-            name = self.pkgInfoById[dep]["name"]
-            if name in PACKAGES_WITH_EXTRA_DEPENDENCIES:
-                extras |= set(PACKAGES_WITH_EXTRA_DEPENDENCIES[name])
+        # There are only a handful of packages with extra dependencies, so it's quicker
+        # to check whether any of them are in `deps` than to look at every dep in turn.
+        for depName in PACKAGES_WITH_EXTRA_DEPENDENCIES.keys() & self.pkgIdsByName.keys():
+            if any(id in deps for id in self.pkgIdsByName[depName]):
+                extras.update(PACKAGES_WITH_EXTRA_DEPENDENCIES[depName])
         return extras
 
     def get_compatible_targets_for_package(self, name, targets=None):
@@ -592,10 +1093,9 @@ class WorkspaceMetadata(object):
             targets = (targets,)
         pkgInfo = self.pkgInfoById[self.workspaceMembersByName[name]]
         # Can't build cdylibs on iOS targets.
-        for buildTarget in pkgInfo["targets"]:
-            if "cdylib" in buildTarget["kind"]:
-                targets = [
-                    target for target in targets if not self.target_is_ios(target)]
+        if "cdylib" in pkgInfo.target_kinds:
+            targets = [
+                target for target in targets if not self.target_is_ios(target)]
         return targets
 
     def target_is_android(self, target):
@@ -613,35 +1113,67 @@ class WorkspaceMetadata(object):
     def is_external_dependency(self, id):
         """Check whether the named package is an external dependency."""
         pkgInfo = self.pkgInfoById[id]
-        try:
-            if pkgInfo["source"] is not None:
-                return True
-        except KeyError:
-            # There's no "source" key in info for externally-managed dependencies
+        if pkgInfo.source is not None:
             return True
-        manifest = pkgInfo["manifest_path"]
-        root = os.path.commonprefix(
-            [manifest, self.metadata["workspace_root"]])
-        if root != self.metadata["workspace_root"]:
+        if pkgInfo.manifest_path is None:
+            # There's no manifest for dependencies managed outside of cargo.
             return True
-        return False
+        manifest = os.path.normpath(pkgInfo.manifest_path)
+        return not manifest.startswith(self._workspaceRootPrefix)
 
     def get_manifest_path(self, id):
         """Get the path to a package's Cargo manifest."""
-        return self.pkgInfoById[id]["manifest_path"]
+        return self.pkgInfoById[id].manifest_path
+
+    def get_license_info(self, id, sharedLicenseTexts=None):
+        """Get the licensing info for the named dependency, or error if it can't be detemined.
 
-    def get_license_info(self, id):
-        """Get the licensing info for the named dependency, or error if it can't be detemined."""
+        If the chosen license is one of those in `sharedLicenseTexts` then we use the text from
+        there, rather than fetching the dependency's own copy of the license text. We still check
+        that the dependency has a license file of its own, though.
+        """
         pkgInfo = self.pkgInfoById[id]
-        chosenLicense = self.pick_most_acceptable_license(
-            id, pkgInfo["license"])
+        chosenLicense = self.get_license(id)
+        licenseText = None
+        if sharedLicenseTexts is not None:
+            licenseText = sharedLicenseTexts.get(chosenLicense, None)
+        if licenseText is None:
+            licenseText = self._fetch_license_text(id, chosenLicense, pkgInfo)
+        else:
+            self._find_license_file(id, chosenLicense, pkgInfo)
         return {
-            "name": pkgInfo["name"],
-            "repository": pkgInfo["repository"],
+            "name": pkgInfo.name,
+            "repository": pkgInfo.repository,
             "license": chosenLicense,
-            "license_text": self._fetch_license_text(id, chosenLicense, pkgInfo),
+            "license_text": licenseText,
         }
 
+    def get_license(self, id):
+        """Get the license under which we will use the named dependency."""
+        return self.pick_most_acceptable_license(id, self.pkgInfoById[id].license)
+
+    def get_shared_license_texts(self, ids):
+        """Get a single representative license text for each license with shared text among the named dependencies.
+
+        Licenses like MPL-2.0 are de-duplicated by name in the summary, so there's no point in fetching
+        the text for every dependency that uses them. Instead we fetch the text for just the first dependency
+        in alphabetical order, which is the copy that `print_dependency_summary` would select.
+        """
+        idsByLicense = collections.defaultdict(list)
+        for id in ids:
+            license = self.get_license(id)
+            if license_has_shared_text(license):
+                idsByLicense[license].append(id)
+        sharedLicenseTexts = {}
+        for license, licenseIds in idsByLicense.items():
+            for id in sorted(licenseIds, key=lambda id: self.pkgInfoById[id].name):
+                licenseText = self._fetch_license_text(
+                    id, license, self.pkgInfoById[id])
+                if license != "Apache-2.0" or is_canonical_apache_license_text(licenseText):
+                    sharedLicenseTexts[license] = licenseText
+                    break
+        return sharedLicenseTexts
+
     def pick_most_acceptable_license(self, id, licenseId):
         """Select the best license under which to redistribute a dependency.
 
@@ -651,8 +1183,10 @@ class WorkspaceMetadata(object):
         here in the license summary tool...
         """
         # Split "A/B" and "A OR B" into individual license names.
-        licenses = set(l.strip()
-                       for l in re.split(r"\s*(?:/|\sOR\s)\s*", licenseId))
+        if "/" not in licenseId and "OR" not in licenseId:
+            licenses = {licenseId.strip()}
+        else:
+            licenses = set(l.strip() for l in LICENSE_SPLIT_RE.split(licenseId))
         # Try to pick the "best" compatible license available.
         for license in LICENES_IN_PREFERENCE_ORDER:
             if license in licenses:
@@ -661,76 +1195,290 @@ class WorkspaceMetadata(object):
             "Could not determine acceptable license for {}; license is '{}'".format(id, licenseId))
 
     def _fetch_license_text(self, id, license, pkgInfo):
-        if "license_text" in pkgInfo:
-            return pkgInfo["license_text"]
-        licenseFile = pkgInfo.get("license_file", None)
+        if pkgInfo.license_text is not None:
+            return pkgInfo.license_text
+        licenseFile = self._find_license_file(id, license, pkgInfo)
+        if licenseFile.startswith("https://"):
+            return download_license_text(licenseFile)
+        return read_license_file(licenseFile)
+
+    def _find_license_file(self, id, license, pkgInfo):
+        """Find the license file for a dependency, as either a local path or a URL.
+
+        This returns None for dependencies that specify their license text directly, and raises
+        an error if we can't unambiguously identify the correct license file.
+        """
+        if pkgInfo.license_text is not None:
+            return None
+        licenseFile = pkgInfo.license_file
         if licenseFile is not None:
             if licenseFile.startswith("https://"):
-                r = requests.get(licenseFile)
-                r.raise_for_status()
-                return r.content.decode("utf8")
+                return licenseFile
             else:
-                pkgRoot = os.path.dirname(pkgInfo["manifest_path"])
-                with open(os.path.join(pkgRoot, licenseFile)) as f:
-                    return f.read()
+                pkgRoot = os.path.dirname(pkgInfo.manifest_path)
+                licenseFile = os.path.join(pkgRoot, licenseFile)
+                # Check this even if we won't read the file, e.g. because it uses a shared license text.
+                if not os.path.isfile(licenseFile):
+                    err = "Could not find license file for '{}'.\n".format(
+                        pkgInfo.name)
+                    err += "The declared license file {} does not exist; ".format(licenseFile)
+                    err += "please correct it in `PACKAGE_METADATA_FIXUPS`."
+                    raise RuntimeError(err)
+                return licenseFile
         # No explicit license file was declared, let's see if we can unambiguously identify one
         # using common naming conventions.
-        pkgRoot = os.path.dirname(pkgInfo["manifest_path"])
+        pkgRoot = os.path.dirname(pkgInfo.manifest_path)
         try:
             licenseFileNames = COMMON_LICENSE_FILE_NAMES[license]
         except KeyError:
             licenseFileNames = COMMON_LICENSE_FILE_NAMES[""]
-        foundLicenseFiles = [nm for nm in os.listdir(
-            pkgRoot) if nm.lower() in licenseFileNames]
+        filesByLowercaseName = list_files_by_lowercase_name(pkgRoot)
+        foundLicenseFiles = sorted(nm
+                                   for lowerName in filesByLowercaseName.keys() & licenseFileNames
+                                   for nm in filesByLowercaseName[lowerName])
         if len(foundLicenseFiles) == 1:
-            with open(os.path.join(pkgRoot, foundLicenseFiles[0])) as f:
-                return f.read()
+            return os.path.join(pkgRoot, foundLicenseFiles[0])
         # We couldn't find the right license text. Let's do what we can to help a human
         # pick the right one and add it to the list of manual fixups.
         if len(foundLicenseFiles) > 1:
             err = "Multiple ambiguous license files found for '{}'.\n".format(
-                pkgInfo["name"])
+                pkgInfo.name)
             err += "Please select the correct license file and add it to `PACKAGE_METADATA_FIXUPS`.\n"
             err += "Potential license files: {}".format(foundLicenseFiles)
         else:
             err = "Could not find license file for '{}'.\n".format(
-                pkgInfo["name"])
+                pkgInfo.name)
             err += "Please locate the correct license file and add it to `PACKAGE_METADATA_FIXUPS`.\n"
             err += "You may need to poke around in the source repository at {}".format(
-                pkgInfo["repository"])
+                pkgInfo.repository)
         raise RuntimeError(err)
 
+    def _prefetch_remote_licenses(self, ids):
+        """Concurrently download any license files that the named dependencies fetch over the network.
+
+        Downloading them one at a time is dominated by network round-trips, so we fetch them
+        all up-front in a thread pool and let `_fetch_license_text` find them in the cache.
+        Many packages share the same license file URL, so we collect the unique URLs first
+        to ensure that each one is only downloaded once.
+        """
+        urls = set()
+        for id in ids:
+            pkgInfo = self.pkgInfoById[id]
+            if pkgInfo.license_text is not None:
+                continue
+            licenseFile = pkgInfo.license_file
+            if licenseFile is not None and licenseFile.startswith("https://"):
+                urls.add(licenseFile)
+        if not urls:
+            return
+        # Make sure the session is created before the worker threads need it.
+        get_http_session()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as executor:
+            for _ in executor.map(download_license_text, urls):
+                pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session():
+    """Get a shared HTTP session for downloading license files.
+
+    This lets us re-use connections to the same host (most of them live on raw.githubusercontent.com)
+    rather than paying for a new TCP and TLS handshake on every request, and retries transient server
+    errors. Importing `requests` is relatively slow, so we only do it once we know we need to download
+    something, which is never the case when `--check` finds that the summary is up-to-date.
+    """
+    import requests
+    import requests.adapters
+    import urllib3.util.retry
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=MAX_CONCURRENT_DOWNLOADS,
+        max_retries=urllib3.util.retry.Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+        ),
+    ))
+    return session
+
+
+# Canonical copies of each distinct license text read from disk, see `read_license_file`.
+LICENSE_TEXTS_BY_CONTENT = {}
+
+
+@functools.lru_cache(maxsize=None)
+def list_files_by_lowercase_name(path):
+    """List the files in the given directory, as a dict mapping lowercased names to actual names."""
+    filesByLowercaseName = collections.defaultdict(list)
+    for nm in os.listdir(path):
+        filesByLowercaseName[nm.lower()].append(nm)
+    return dict(filesByLowercaseName)
+
+
+@functools.lru_cache(maxsize=None)
+def read_license_file(path):
+    """Read the text of a license file from disk.
+
+    Results are memoized by path so that each file is only read once, and identical texts
+    from different files (e.g. from multiple versions of the same crate) share a single
+    copy in memory.
+    """
+    with open(path) as f:
+        text = f.read()
+    return LICENSE_TEXTS_BY_CONTENT.setdefault(text, text)
+
+
+@functools.lru_cache(maxsize=None)
+def download_license_text(url):
+    """Download the text of a license file from the given URL.
+
+    Results are memoized by URL, since many packages point at the same license file.
+
+    Downloaded files are kept in an on-disk cache under `LICENSE_CACHE_DIR`, so that repeated runs
+    don't have to hit the network. Once a cached copy is older than `LICENSE_CACHE_MAX_AGE` we
+    revalidate it using the `ETag` and `Last-Modified` headers from the original response.
+    """
+    cachePath = os.path.join(get_workspace_root() or os.curdir,
+                             LICENSE_CACHE_DIR, hashlib.sha256(url.encode("utf8")).hexdigest())
+    headers = {}
+    try:
+        with open(cachePath, "rb") as f:
+            cachedContent = f.read()
+        with open(cachePath + ".json", "r") as f:
+            cachedHeaders = json.load(f)
+    except FileNotFoundError:
+        cachedContent = None
+    else:
+        if time.time() - os.path.getmtime(cachePath) < LICENSE_CACHE_MAX_AGE:
+            return cachedContent.decode("utf8")
+        if cachedHeaders.get("etag") is not None:
+            headers["If-None-Match"] = cachedHeaders["etag"]
+        if cachedHeaders.get("last_modified") is not None:
+            headers["If-Modified-Since"] = cachedHeaders["last_modified"]
+    r = get_http_session().get(url, headers=headers, timeout=HTTP_REQUEST_TIMEOUT)
+    if r.status_code == 304 and cachedContent is not None:
+        # Still fresh, so reset the clock on the cached copy.
+        os.utime(cachePath)
+        return cachedContent.decode("utf8")
+    r.raise_for_status()
+    _write_file_atomically(cachePath + ".json", json.dumps({
+        "url": url,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+    }).encode("utf8"))
+    _write_file_atomically(cachePath, r.content)
+    return r.content.decode("utf8")
+
+
+def _write_file_atomically(path, content):
+    """Write bytes to the given path, such that concurrent readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(tmpPath, path)
+
+
+def get_dependency_name(decl):
+    """Get the name by which a package refers to one of its dependencies, e.g. in its list of features."""
+    return decl["rename"] if decl["rename"] is not None else decl["name"]
+
+
+# Tokens in a `cfg(...)` expression: identifiers, string literals, and punctuation.
+CFG_TOKEN_RE = re.compile(r'\s*(?:([A-Za-z_][A-Za-z0-9_]*)|"([^"]*)"|([(),=]))')
+
+
+def evaluate_cfg_expression(expr, cfg):
+    """Evaluate the body of a `cfg(...)` expression against a set of `(key, value)` config pairs.
+
+    Ref https://doc.rust-lang.org/reference/conditional-compilation.html for the syntax.
+    """
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        m = CFG_TOKEN_RE.match(expr, pos)
+        if m is None:
+            raise RuntimeError("Could not parse cfg expression '{}'".format(expr))
+        tokens.append(m.group(1, 2, 3))
+        pos = m.end()
+    tokens.reverse()
+
+    def expect(punct):
+        if not tokens or tokens.pop()[2] != punct:
+            raise RuntimeError("Expected '{}' in cfg expression '{}'".format(punct, expr))
+
+    def parse_predicate():
+        if not tokens or tokens[-1][0] is None:
+            raise RuntimeError("Expected identifier in cfg expression '{}'".format(expr))
+        ident = tokens.pop()[0]
+        if ident in ("all", "any", "not") and tokens and tokens[-1][2] == "(":
+            expect("(")
+            results = []
+            while tokens and tokens[-1][2] != ")":
+                results.append(parse_predicate())
+                if tokens and tokens[-1][2] == ",":
+                    tokens.pop()
+            expect(")")
+            if ident == "all":
+                return all(results)
+            if ident == "any":
+                return any(results)
+            if len(results) != 1:
+                raise RuntimeError("Expected exactly one argument to not() in cfg expression '{}'".format(expr))
+            return not results[0]
+        if tokens and tokens[-1][2] == "=":
+            tokens.pop()
+            if not tokens or tokens[-1][1] is None:
+                raise RuntimeError("Expected string in cfg expression '{}'".format(expr))
+            return (ident, tokens.pop()[1]) in cfg
+        return (ident, None) in cfg
+
+    result = parse_predicate()
+    if tokens:
+        raise RuntimeError("Unexpected trailing tokens in cfg expression '{}'".format(expr))
+    return result
+
+
+def print_dependency_summary(deps, file=sys.stdout, fingerprint=None):
+    """Print a nicely-formatted summary of dependencies and their license info.
+
+    If `fingerprint` is given, it is recorded in a header line at the start of the output.
+    """
+    # Accumulate the output and write it all at once at the end, which is
+    # much cheaper than many small calls to `print`.
+    lines = []
+    if fingerprint is not None:
+        lines.append(FINGERPRINT_HEADER.format(fingerprint))
 
-def print_dependency_summary(deps, file=sys.stdout):
-    """Print a nicely-formatted summary of dependencies and their license info."""
     def pf(string, *args):
         if args:
             string = string.format(*args)
-        print(string, file=file)
+        lines.append(string)
 
     # Dedupe by shared license text where possible.
     depsByLicenseTextHash = collections.defaultdict(list)
     for info in deps:
-        if info["license"] in ("MPL-2.0", "Apache-2.0") or info["license"].startswith("EXT-"):
-            # We know these licenses to have shared license text, sometimes differing on e.g. punctuation details.
-            # XXX TODO: should check this more explicitly to ensure they contain the expected text.
+        if license_has_shared_text(info["license"]):
             licenseTextHash = info["license"]
         else:
             # Other license texts typically include copyright notices that we can't dedupe, except on whitespace.
-            text = "".join(info["license_text"].split())
             licenseTextHash = info["license"] + ":" + \
-                hashlib.sha256(text.encode("utf8")).hexdigest()
+                hash_ignoring_whitespace(info["license_text"])
         depsByLicenseTextHash[licenseTextHash].append(info)
 
     # List licenses in the order in which we prefer them, then in alphabetical order
     # of the dependency names. This ensures a convenient and stable ordering.
-    def sort_key(licenseTextHash):
-        for i, license in enumerate(LICENES_IN_PREFERENCE_ORDER):
-            if licenseTextHash.startswith(license):
-                return (i, sorted(info["name"] for info in depsByLicenseTextHash[licenseTextHash]))
-        return (i + 1, sorted(info["name"] for info in depsByLicenseTextHash[licenseTextHash]))
+    sortKeys = {}
+    for licenseTextHash, infos in depsByLicenseTextHash.items():
+        license = licenseTextHash.split(":")[0]
+        sortKeys[licenseTextHash] = (
+            LICENSE_PREFERENCE_RANK.get(license, len(LICENSE_PREFERENCE_RANK)),
+            sorted(info["name"] for info in infos),
+        )
 
-    sections = sorted(depsByLicenseTextHash.keys(), key=sort_key)
+    sections = sorted(depsByLicenseTextHash.keys(), key=sortKeys.__getitem__)
 
     pf("# Licenses for Third-Party Dependencies")
     pf("")
@@ -751,18 +1499,16 @@ def print_dependency_summary(deps, file=sys.stdout):
     for licenseTextHash in sections:
         deps = sorted(
             depsByLicenseTextHash[licenseTextHash], key=lambda i: i["name"])
-        licenseText = deps[0]["license_text"]
-        for dep in deps:
-            licenseText = dep["license_text"]
+        if licenseTextHash == "Apache-2.0":
             # As a bit of a hack, we need to find a copy of the "canonical" apache license text
             # that still has the copyright placeholders in it, and no project-specific additions.
-            if licenseTextHash != "Apache-2.0":
-                break
-            if "[yyyy]" in licenseText and "NSS" not in licenseText:
-                break
+            licenseText = next((dep["license_text"] for dep in deps
+                                if is_canonical_apache_license_text(dep["license_text"])), None)
+            if licenseText is None:
+                raise RuntimeError(
+                    "Could not find appropriate apache license text")
         else:
-            raise RuntimeError(
-                "Could not find appropriate apache license text")
+            licenseText = deps[0]["license_text"]
         pf("## {}", format_license_header(licenseTextHash, deps))
         pf("")
         pkgs = ["[{}]({})".format(info["name"], info["repository"])
@@ -777,6 +1523,172 @@ def print_dependency_summary(deps, file=sys.stdout):
         pf("```")
         pf("-------------")
 
+    lines.append("")
+    file.write("\n".join(lines))
+
+
+def write_dependency_summary_json(deps, file=None):
+    """Write the summary of dependencies and their license info as a JSON list, to a binary file.
+
+    This writes each dependency as soon as it's available, rather than collecting
+    them all into a list in memory first. Multiple versions of the same dependency will
+    often have identical info, in which case we only write it once.
+
+    If no file is given, this writes to the binary buffer underlying `sys.stdout`.
+    """
+    if file is None:
+        file = sys.stdout.buffer
+    seen = set()
+    file.write(b"[")
+    for info in deps:
+        key = (info["name"], info["repository"], info["license"], info["license_text"])
+        if key in seen:
+            continue
+        if seen:
+            file.write(b",")
+        seen.add(key)
+        file.write(serialize_json(info))
+    file.write(b"]")
+
+
+class CompareWriter(io.IOBase):
+    """A writable stream that checks everything written to it against the contents of a file.
+
+    Rather than buffering the full output in memory, this memory-maps the file and compares each
+    write directly against the corresponding part of the mapping, raising an error as soon as
+    anything differs. Call `finish` once all output has been written, to check that there's nothing
+    left over in the file.
+
+    If `binary` is true then this accepts bytes rather than text. In text mode, line endings in the
+    file are normalized like they would be by `open(path, "r")`, so that e.g. a checkout with CRLF
+    line endings still matches our output. Any fingerprint header at the start of the file is also
+    skipped, since it records how the file was generated rather than what it contains.
+    """
+
+    def __init__(self, path, binary=False):
+        super().__init__()
+        self.path = path
+        self.binary = binary
+        with open(path, "rb") as f:
+            # Empty files can't be mapped, but there's nothing to compare against in that case anyway.
+            if os.fstat(f.fileno()).st_size:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._mmap = None
+        self._data = self._mmap if self._mmap is not None else b""
+        if not binary and self._data.find(b"\r") != -1:
+            # Normalizing line endings means making a copy of the file, so we only do it if we have to.
+            self._data = self._data[:].replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        # Slicing a memoryview doesn't copy, so we can compare against the file without reading it.
+        self._expected = memoryview(self._data)
+        self._offset = 0
+        if not binary:
+            m = FINGERPRINT_HEADER_RE.match(self._read_line())
+            if m is not None:
+                self._offset = m.end()
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        data = s if self.binary else s.encode("utf8")
+        end = self._offset + len(data)
+        if self._expected[self._offset:end] != data:
+            self._fail()
+        self._offset = end
+        return len(s)
+
+    def finish(self):
+        try:
+            if self._offset != len(self._expected):
+                self._fail()
+        finally:
+            self.close()
+
+    def close(self):
+        self._expected.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        super().close()
+
+    def _read_line(self):
+        newline = self._data.find(b"\n")
+        end = newline + 1 if newline != -1 else len(self._data)
+        return self._expected[:end].tobytes().decode("utf8", errors="replace")
+
+    def _fail(self):
+        raise RuntimeError(
+            "Dependency details have changed from those in {}".format(self.path))
+
+
+class HashCompareWriter(io.IOBase):
+    """A writable stream that checks everything written to it against a hash of the expected output.
+
+    This is a cheaper alternative to `CompareWriter` for when the file being checked has a `.sha256`
+    sidecar file, as written by `sha256sum`, containing the sha256 digest of the file exactly as we
+    generated it. We only hash the output as it's written, and never need to read the file itself,
+    apart from its fingerprint header. Call `finish` once all output has been written, to compare
+    the digests.
+
+    In text mode, the output we're checking won't include the fingerprint header, but the digest
+    will. So we hash the file's own header along with the output, which means that the check still
+    passes if only the inputs have changed, and not the output.
+    """
+
+    def __init__(self, path, sha256Path, binary=False):
+        super().__init__()
+        self.path = path
+        self.binary = binary
+        with open(sha256Path, "r") as f:
+            m = SHA256_SIDECAR_RE.match(f.read())
+        if m is None:
+            raise RuntimeError(
+                "Could not read a sha256 digest from {}; expected the output of `sha256sum`".format(sha256Path))
+        self._expectedDigest = m.group(1).lower()
+        self._hasher = hashlib.sha256()
+        if not binary:
+            fingerprint = read_fingerprint_header(path)
+            if fingerprint is not None:
+                self._hasher.update((FINGERPRINT_HEADER.format(fingerprint) + "\n").encode("utf8"))
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        self._hasher.update(s if self.binary else s.encode("utf8"))
+        return len(s)
+
+    def finish(self):
+        try:
+            if self._hasher.hexdigest() != self._expectedDigest:
+                self._fail()
+        finally:
+            self.close()
+
+    def _fail(self):
+        raise RuntimeError(
+            "Dependency details have changed from those in {}".format(self.path))
+
+
+def license_has_shared_text(license):
+    """Check whether all dependencies using the given license can share a single copy of its text."""
+    # We know these licenses to have shared license text, sometimes differing on e.g. punctuation details.
+    # XXX TODO: should check this more explicitly to ensure they contain the expected text.
+    return license in ("MPL-2.0", "Apache-2.0") or license.startswith("EXT-")
+
+
+def is_canonical_apache_license_text(licenseText):
+    """Check whether the given text is the "canonical" apache license text.
+
+    This is the text that still has the copyright placeholders in it, and no project-specific additions.
+    """
+    return "[yyyy]" in licenseText and "NSS" not in licenseText
+
+
+def hash_ignoring_whitespace(text):
+    """Get a sha256 hex digest of the given text, ignoring any differences in whitespace."""
+    return hashlib.sha256(WHITESPACE_RE.sub("", text).encode("utf8")).hexdigest()
+
 
 def format_license_header(license, deps):
     if license == "MPL-2.0":
@@ -799,46 +1711,159 @@ def header_to_anchor(header):
     return header.lower().replace(" ", "-").replace(".", "").replace(",", "").replace(":", "")
 
 
+USAGE = """\
+usage: dependency_summary.py [-h] [-p PACKAGE] [--target TARGET] [--all-android-targets]
+                             [--all-ios-targets] [--json] [--check CHECK]
+"""
+
+HELP = USAGE + """
+summarize dependencies and license information
+
+options:
+  -h, --help            show this help message and exit
+  -p PACKAGE, --package PACKAGE
+  --target TARGET
+  --all-android-targets
+  --all-ios-targets
+  --json                output JSON rather than human-readable text
+  --check CHECK         suppress output, instead checking that it matches the given file
+"""
+
+
+# The long options accepted by `parse_args`.
+LONG_OPTIONS = (
+    "--help",
+    "--package",
+    "--target",
+    "--all-android-targets",
+    "--all-ios-targets",
+    "--json",
+    "--check",
+)
+
+
+class CommandLineArguments(object):
+    """The options given on the command-line, as parsed by `parse_args`."""
+
+    def __init__(self):
+        self.packages = None
+        self.targets = None
+        self.json = False
+        self.check = None
+
+
+def parse_args(argv):
+    """Parse command-line arguments.
+
+    We only have a handful of simple options, so it's worth parsing them by hand rather than
+    paying the startup cost of `argparse`. This follows `argparse` conventions for the things
+    we support, including accepting unambiguous prefixes of long options, and printing usage
+    and exiting with status 2 on error.
+    """
+    def usage_error(msg):
+        sys.stderr.write(USAGE)
+        sys.stderr.write("dependency_summary.py: error: {}\n".format(msg))
+        sys.exit(2)
+
+    args = CommandLineArguments()
+    unrecognized = []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg == "--":
+            # Everything after this would be a positional argument, but we don't take any.
+            unrecognized.append(arg)
+            unrecognized.extend(argv)
+            break
+        if arg.startswith("--"):
+            name, hasValue, value = arg.partition("=")
+            if name not in LONG_OPTIONS:
+                matches = [option for option in LONG_OPTIONS if option.startswith(name)]
+                if len(matches) > 1:
+                    usage_error("ambiguous option: {} could match {}".format(name, ", ".join(matches)))
+                if matches:
+                    name = matches[0]
+        elif arg.startswith("-p") and len(arg) > 2:
+            # Allow both "-pNAME" and "-p=NAME".
+            name, hasValue, value = "-p", True, arg[2:]
+            if value.startswith("="):
+                value = value[1:]
+        else:
+            name, hasValue, value = arg, False, None
+        if name in ("-h", "--help"):
+            sys.stdout.write(HELP)
+            sys.exit(0)
+        if name in ("-p", "--package", "--target", "--check"):
+            if not hasValue:
+                # Anything that looks like an option can't be used as a value, unless given with "=".
+                if not argv or (argv[0].startswith("-") and argv[0] != "-"):
+                    usage_error("argument {}: expected one argument".format(
+                        "-p/--package" if name in ("-p", "--package") else name))
+                value = argv.pop(0)
+            if name == "--check":
+                args.check = value
+            elif name == "--target":
+                args.targets = (args.targets or []) + [value]
+            else:
+                args.packages = (args.packages or []) + [value]
+        elif name in ("--all-android-targets", "--all-ios-targets", "--json"):
+            if hasValue:
+                usage_error("argument {}: ignored explicit argument '{}'".format(name, value))
+            if name == "--all-android-targets":
+                args.targets = (args.targets or []) + ALL_ANDROID_TARGETS
+            elif name == "--all-ios-targets":
+                args.targets = (args.targets or []) + ALL_IOS_TARGETS
+            else:
+                args.json = True
+        else:
+            unrecognized.append(arg)
+    if unrecognized:
+        usage_error("unrecognized arguments: {}".format(" ".join(unrecognized)))
+    return args
+
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description="summarize dependencies and license information")
-    parser.add_argument('-p', '--package', action="append", dest="packages")
-    parser.add_argument('--target', action="append", dest="targets")
-    parser.add_argument('--all-android-targets', action="append_const",
-                        dest="targets", const=ALL_ANDROID_TARGETS)
-    parser.add_argument('--all-ios-targets', action="append_const",
-                        dest="targets", const=ALL_IOS_TARGETS)
-    parser.add_argument('--json', action="store_true",
-                        help="output JSON rather than human-readable text")
-    parser.add_argument('--check', action="store",
-                        help="suppress output, instead checking that it matches the given file")
-    args = parser.parse_args()
+    args = parse_args(sys.argv[1:])
 
     # Default to listing dependencies for the "megazord" and "megazord_ios" packages,
     # which together include everything we might possibly incorporate into in a built distribution.
     if not args.packages:
         args.packages = ["megazord", "megazord_ios"]
 
-    if args.targets:
-        # Flatten the lists introduced by --all-XXX-targets options.
-        args.targets = list(itertools.chain(
-            *([t] if isinstance(t, str) else t for t in args.targets)))
+    # The workspace fingerprint is needed for both the summary's fingerprint and for caching
+    # the workspace metadata, and computing it means reading every manifest, so only do it once.
+    workspaceRoot = get_workspace_root()
+    workspaceFingerprint = None
+    if workspaceRoot is not None:
+        workspaceFingerprint = get_workspace_fingerprint(workspaceRoot)
 
-    metadata = get_workspace_metadata()
-    deps = metadata.get_dependency_summary(args.packages, args.targets)
+    # The markdown summary records a fingerprint of its inputs. If the file we're checking was
+    # generated from exactly the same inputs, then we know it's up-to-date without doing any work.
+    fingerprint = None
+    if not args.json and workspaceFingerprint is not None:
+        fingerprint = get_summary_fingerprint(workspaceFingerprint, args.packages, args.targets)
+        if args.check and read_fingerprint_header(args.check) == fingerprint:
+            sys.exit(0)
+
+    metadata = get_workspace_metadata(workspaceFingerprint)
+    deps = metadata.get_dependency_summary(
+        args.packages, args.targets, shareLicenseTexts=not args.json)
 
     if args.check:
-        output = io.StringIO()
+        if os.path.exists(args.check + ".sha256"):
+            output = HashCompareWriter(args.check, args.check + ".sha256", binary=args.json)
+        else:
+            output = CompareWriter(args.check, binary=args.json)
+    elif args.json:
+        output = sys.stdout.buffer
     else:
         output = sys.stdout
 
     if args.json:
-        json.dump([info for info in deps], output)
+        write_dependency_summary_json(deps, file=output)
     else:
-        print_dependency_summary(deps, file=output)
+        print_dependency_summary(
+            deps, file=output, fingerprint=None if args.check else fingerprint)
 
     if args.check:
-        with open(args.check, 'r') as f:
-            if f.read() != output.getvalue():
-                raise RuntimeError(
-                    "Dependency details have changed from those in {}".format(args.check))
+        output.finish()
@@ -5,3 +5,11 @@ python3 ./tools/dependency_summary.py --all-android-targets --package megazord >
 python3 ./tools/dependency_summary.py --all-ios-targets --package megazord_ios > megazords/ios/DEPENDENCIES.md
 python3 ./tools/dependency_summary.py --all-android-targets --package fenix > megazords/fenix/DEPENDENCIES.md
 python3 ./tools/dependency_summary.py --all-android-targets --package lockbox > megazords/lockbox/DEPENDENCIES.md
+
+# Keep any `.sha256` sidecar files, which `dependency_summary.py --check` uses in preference
+# to the summaries themselves, up-to-date with the regenerated summaries.
+for summary in ./DEPENDENCIES.md megazords/*/DEPENDENCIES.md; do
+    if [ -f "$summary.sha256" ]; then
+        sha256sum "$summary" > "$summary.sha256"
+    fi
+done
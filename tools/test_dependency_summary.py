@@ -0,0 +1,453 @@
+#
+# Tests for the parts of dependency_summary.py that don't need to shell out to cargo.
+# Run them like this:
+#
+#    $> python3 -m unittest discover --start-directory tools --pattern "test_*.py"
+
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+
+import dependency_summary
+
+
+LINUX_CFG = {
+    ("unix", None),
+    ("target_os", "linux"),
+    ("target_family", "unix"),
+    ("target_pointer_width", "64"),
+}
+
+WINDOWS_CFG = {
+    ("windows", None),
+    ("target_os", "windows"),
+    ("target_family", "windows"),
+    ("target_pointer_width", "64"),
+}
+
+
+class EvaluateCfgExpressionTests(unittest.TestCase):
+
+    def check(self, expr, linux, windows):
+        self.assertEqual(dependency_summary.evaluate_cfg_expression(expr, LINUX_CFG), linux, expr)
+        self.assertEqual(dependency_summary.evaluate_cfg_expression(expr, WINDOWS_CFG), windows, expr)
+
+    def test_names(self):
+        self.check("unix", True, False)
+        self.check("windows", False, True)
+        self.check("target_os", False, False)
+
+    def test_key_value_pairs(self):
+        self.check('target_os = "linux"', True, False)
+        self.check('target_os="windows"', False, True)
+        self.check('target_pointer_width = "32"', False, False)
+        self.check('unix = "linux"', False, False)
+
+    def test_all_any_not(self):
+        self.check("not(windows)", True, False)
+        self.check('all(unix, target_pointer_width = "64")', True, False)
+        self.check('all(unix, target_pointer_width = "32")', False, False)
+        self.check('any(target_os = "android", target_os = "linux")', True, False)
+        self.check("any(unix, windows,)", True, True)
+        self.check("all()", True, True)
+        self.check("any()", False, False)
+
+    def test_nesting(self):
+        self.check('all(not(any(target_os = "macos", target_os = "ios")), not(windows))', True, False)
+        self.check("not(not(windows))", False, True)
+
+    def test_operators_as_plain_names(self):
+        # These are only special when followed by an argument list.
+        self.check("all", False, False)
+        self.check('any = "thing"', False, False)
+
+    def test_errors(self):
+        for expr in ("", "not(unix, windows)", "not()", "all(unix", "unix windows",
+                     "target_os =", "target_os = linux", '"linux"', "unix)", "unix && windows"):
+            with self.assertRaises(RuntimeError, msg=expr):
+                dependency_summary.evaluate_cfg_expression(expr, LINUX_CFG)
+
+
+def make_package(name, dependencies=(), features=None, kinds=("lib",)):
+    return {
+        "id": name,
+        "name": name,
+        "manifest_path": "/ws/{}/Cargo.toml".format(name),
+        "source": None,
+        "repository": None,
+        "license": "MIT",
+        "license_file": None,
+        "targets": [{"kind": list(kinds)}],
+        "dependencies": [make_dependency(**dep) for dep in dependencies],
+        "features": features or {},
+    }
+
+
+def make_dependency(name, kind=None, target=None, optional=False, default=True, features=(), rename=None):
+    return {
+        "name": name,
+        "rename": rename,
+        "kind": kind,
+        "target": target,
+        "optional": optional,
+        "uses_default_features": default,
+        "features": list(features),
+    }
+
+
+def make_metadata(packages, members):
+    """Make fake `cargo metadata` output for the given packages, with every dependency enabled."""
+    nodes = []
+    for package in packages:
+        deps = {}
+        for dep in package["dependencies"]:
+            name = (dep["rename"] or dep["name"]).replace("-", "_")
+            edge = deps.setdefault(name, {"name": name, "pkg": dep["name"], "dep_kinds": []})
+            edge["dep_kinds"].append({"kind": dep["kind"], "target": dep["target"]})
+        nodes.append({"id": package["id"], "deps": list(deps.values())})
+    return {
+        "packages": packages,
+        "workspace_members": members,
+        "workspace_root": "/ws",
+        "resolve": {"nodes": nodes},
+    }
+
+
+class GetPackageDependenciesTests(unittest.TestCase):
+
+    def make_workspace(self, packages, members):
+        metadata = dependency_summary.WorkspaceMetadata(make_metadata(packages, members))
+        # Avoid shelling out to `rustc`.
+        metadata._hostTarget = "x86_64-unknown-linux-gnu"
+        metadata._targetCfgCache["x86_64-unknown-linux-gnu"] = LINUX_CFG
+        metadata._targetCfgCache["x86_64-pc-windows-msvc"] = WINDOWS_CFG
+        return metadata
+
+    def get_deps(self, metadata, name, target="x86_64-unknown-linux-gnu"):
+        return metadata.get_package_dependencies_for_target(name, target)
+
+    def test_features_of_other_workspace_members_are_not_unified(self):
+        metadata = self.make_workspace([
+            make_package("app", [dict(name="lib")]),
+            make_package("other", [dict(name="lib", features=["extra"])]),
+            make_package("lib", [dict(name="opt", optional=True)], {"extra": ["opt"]}),
+            make_package("opt"),
+        ], ["app", "other"])
+        self.assertEqual(self.get_deps(metadata, "app"), {"app", "lib"})
+        self.assertEqual(self.get_deps(metadata, "other"), {"other", "lib", "opt"})
+
+    def test_default_features(self):
+        metadata = self.make_workspace([
+            make_package("app", [dict(name="a"), dict(name="b", default=False, features=["x"])]),
+            make_package("a", [dict(name="adef", optional=True)], {"default": ["adef"]}),
+            make_package("b", [dict(name="bdef", optional=True), dict(name="bx", optional=True)],
+                         {"default": ["bdef"], "x": ["dep:bx"]}),
+            make_package("adef"),
+            make_package("bdef"),
+            make_package("bx"),
+        ], ["app"])
+        self.assertEqual(self.get_deps(metadata, "app"), {"app", "a", "adef", "b", "bx"})
+
+    def test_dependency_features(self):
+        metadata = self.make_workspace([
+            make_package("app", [dict(name="a", optional=True), dict(name="b", optional=True),
+                                 dict(name="c", optional=True, rename="cc")],
+                         {"default": ["a/inner", "b?/inner", "cc"]}),
+            make_package("a", [dict(name="ai", optional=True)], {"inner": ["ai"]}),
+            make_package("b", [dict(name="bi", optional=True)], {"inner": ["bi"]}),
+            make_package("c"),
+            make_package("ai"),
+            make_package("bi"),
+        ], ["app"])
+        # The weak "b?/inner" doesn't enable "b" itself, but "cc" enables the renamed "c".
+        self.assertEqual(self.get_deps(metadata, "app"), {"app", "a", "ai", "c"})
+
+    def test_weak_dependency_features_apply_once_enabled(self):
+        metadata = self.make_workspace([
+            make_package("app", [dict(name="b", optional=True)], {"default": ["b?/inner", "later"], "later": ["b"]}),
+            make_package("b", [dict(name="bi", optional=True)], {"inner": ["bi"]}),
+            make_package("bi"),
+        ], ["app"])
+        self.assertEqual(self.get_deps(metadata, "app"), {"app", "b", "bi"})
+
+    def test_declared_features_of_dependencies(self):
+        metadata = self.make_workspace([
+            make_package("app", [dict(name="a", features=["b/x", "dep:c", "d?/x"])]),
+            make_package("a", [dict(name="b"), dict(name="c", optional=True), dict(name="d", optional=True)]),
+            make_package("b", [dict(name="bx", optional=True)], {"x": ["bx"]}),
+            make_package("c"),
+            make_package("d", [dict(name="dx", optional=True)], {"x": ["dx"]}),
+            make_package("bx"),
+            make_package("dx"),
+        ], ["app"])
+        # Features requested by a dependency declaration are parsed the same way as those in the features table.
+        self.assertEqual(self.get_deps(metadata, "app"), {"app", "a", "b", "bx", "c"})
+
+    def test_dev_dependencies(self):
+        metadata = self.make_workspace([
+            make_package("app", [dict(name="lib"), dict(name="c", features=["x"], kind="dev"),
+                                 dict(name="devonly", kind="dev")]),
+            make_package("lib", [dict(name="c"), dict(name="d"), dict(name="d", features=["x"], kind="dev")]),
+            make_package("c", [dict(name="cx", optional=True)], {"x": ["cx"]}),
+            make_package("d", [dict(name="dx", optional=True)], {"x": ["dx"]}),
+            make_package("cx"),
+            make_package("dx"),
+            make_package("devonly"),
+        ], ["app", "lib"])
+        # Like cargo, we unify features requested by the package's own dev-dependencies,
+        # but not those of its dependencies, and never include dev-dependencies themselves.
+        self.assertEqual(self.get_deps(metadata, "app"), {"app", "lib", "c", "cx", "d"})
+
+    def test_platform_specific_dependencies(self):
+        metadata = self.make_workspace([
+            make_package("app", [dict(name="u", target="cfg(unix)"), dict(name="w", target="cfg(windows)"),
+                                 dict(name="a", target="x86_64-pc-windows-msvc", features=["x"]),
+                                 dict(name="a")]),
+            make_package("a", [dict(name="ax", optional=True)], {"x": ["ax"]}),
+            make_package("ax"),
+            make_package("u"),
+            make_package("w"),
+        ], ["app"])
+        # Features are unified across platforms, even though the dependencies themselves aren't.
+        self.assertEqual(self.get_deps(metadata, "app"), {"app", "a", "ax", "u"})
+        self.assertEqual(self.get_deps(metadata, "app", "x86_64-pc-windows-msvc"), {"app", "a", "ax", "w"})
+
+    def test_host_dependencies(self):
+        metadata = self.make_workspace([
+            make_package("app", [dict(name="bd", kind="build", target="cfg(unix)"), dict(name="pm")]),
+            make_package("bd", [dict(name="bdu", target="cfg(unix)"), dict(name="bdw", target="cfg(windows)")]),
+            make_package("pm", [dict(name="pmu", target="cfg(unix)"), dict(name="pmw", target="cfg(windows)")],
+                         kinds=("proc-macro",)),
+            make_package("bdu"),
+            make_package("bdw"),
+            make_package("pmu"),
+            make_package("pmw"),
+        ], ["app"])
+        # Build dependencies and proc-macros are compiled for the host, regardless of the target.
+        expected = {"app", "bd", "bdu", "pm", "pmu"}
+        self.assertEqual(self.get_deps(metadata, "app"), expected)
+        self.assertEqual(self.get_deps(metadata, "app", "x86_64-pc-windows-msvc"), expected)
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    """A test case that creates a temporary directory, at `self.tmpdir`, for each test."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+
+class GetLicenseInfoTests(TemporaryDirectoryTestCase):
+
+    def make_package(self, name, license, files):
+        os.makedirs(os.path.join(self.tmpdir, name))
+        for filename, text in files.items():
+            with open(os.path.join(self.tmpdir, name, filename), "w") as f:
+                f.write(text)
+        package = make_package(name)
+        package["license"] = license
+        package["manifest_path"] = os.path.join(self.tmpdir, name, "Cargo.toml")
+        return package
+
+    def test_shared_license_texts(self):
+        metadata = dependency_summary.WorkspaceMetadata(make_metadata([
+            self.make_package("a", "MPL-2.0", {"LICENSE": "MPL text from a"}),
+            self.make_package("b", "MPL-2.0", {"LICENSE.txt": "MPL text from b"}),
+            self.make_package("c", "MIT", {"LICENSE-MIT": "MIT text from c"}),
+        ], ["a"]))
+        shared = metadata.get_shared_license_texts(["a", "b", "c"])
+        self.assertEqual(shared, {"MPL-2.0": "MPL text from a"})
+        self.assertEqual(metadata.get_license_info("b", shared)["license_text"], "MPL text from a")
+        self.assertEqual(metadata.get_license_info("b")["license_text"], "MPL text from b")
+        self.assertEqual(metadata.get_license_info("c", shared)["license_text"], "MIT text from c")
+
+    def test_shared_license_texts_still_require_a_license_file(self):
+        metadata = dependency_summary.WorkspaceMetadata(make_metadata([
+            self.make_package("a", "MPL-2.0", {"LICENSE": "MPL text from a"}),
+            self.make_package("b", "MPL-2.0", {"LICENSE-MIT": "", "COPYING": ""}),
+            self.make_package("c", "MPL-2.0", {"LICENSE": "", "LICENSE.md": ""}),
+        ], ["a"]))
+        shared = metadata.get_shared_license_texts(["a"])
+        with self.assertRaisesRegex(RuntimeError, "Could not find license file for 'b'"):
+            metadata.get_license_info("b", shared)
+        with self.assertRaisesRegex(RuntimeError, "Multiple ambiguous license files found for 'c'"):
+            metadata.get_license_info("c", shared)
+
+    def test_shared_license_texts_still_require_the_declared_license_file(self):
+        a = self.make_package("a", "MPL-2.0", {"LICENSE": "MPL text from a"})
+        b = self.make_package("b", "MPL-2.0", {"LICENSE": ""})
+        b["license_file"] = "MISSING-LICENSE"
+        metadata = dependency_summary.WorkspaceMetadata(make_metadata([a, b], ["a"]))
+        shared = metadata.get_shared_license_texts(["a"])
+        for sharedLicenseTexts in (shared, None):
+            with self.assertRaisesRegex(RuntimeError, "Could not find license file for 'b'"):
+                metadata.get_license_info("b", sharedLicenseTexts)
+
+
+class CompareWriterTests(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmpdir, "expected")
+
+    def check(self, expected, chunks, binary=False):
+        with open(self.path, "wb") as f:
+            f.write(expected)
+        writer = dependency_summary.CompareWriter(self.path, binary=binary)
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.finish()
+
+    def test_matches(self):
+        self.check(b"line one\nline two\n", ["line one\n", "line", " two\n"])
+        self.check(b"\xc3\xa9t\xc3\xa9\n", ["\u00e9t\u00e9\n"])
+        self.check(b"", [])
+        self.check(b"[1,2]", [b"[1,", b"2]"], binary=True)
+
+    def test_mismatches(self):
+        for expected, chunks in ((b"line one\n", ["line two\n"]),
+                                 (b"line one\n", ["line one\n", "more\n"]),
+                                 (b"line one\nmore\n", ["line one\n"]),
+                                 (b"", ["line one\n"])):
+            with self.assertRaisesRegex(RuntimeError, "Dependency details have changed"):
+                self.check(expected, chunks)
+
+    def test_skips_fingerprint_header(self):
+        self.check(b"<!-- dependency-summary-fingerprint: 0123abcd -->\nline one\n", ["line one\n"])
+        with self.assertRaises(RuntimeError):
+            self.check(b"<!-- not a fingerprint -->\nline one\n", ["line one\n"])
+
+    def test_normalizes_line_endings_in_text_mode(self):
+        self.check(b"<!-- dependency-summary-fingerprint: 0123abcd -->\r\nline one\r\nline two\r\n",
+                   ["line one\nline two\n"])
+        self.check(b"line one\rline two\n", ["line one\nline two\n"])
+        with self.assertRaises(RuntimeError):
+            self.check(b"line one\r\n", [b"line one\n"], binary=True)
+
+
+class HashCompareWriterTests(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmpdir, "expected")
+        self.sha256Path = self.path + ".sha256"
+
+    def write_sidecar(self, contents):
+        with open(self.sha256Path, "w") as f:
+            f.write(contents)
+
+    def check(self, expected, chunks, binary=False):
+        # Write the sidecar in the same format as `sha256sum`.
+        with open(self.path, "wb") as f:
+            f.write(expected)
+        self.write_sidecar("{}  {}\n".format(hashlib.sha256(expected).hexdigest(), self.path))
+        writer = dependency_summary.HashCompareWriter(self.path, self.sha256Path, binary=binary)
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.finish()
+
+    def test_matches(self):
+        self.check(b"line one\nline two\n", ["line one\n", "line", " two\n"])
+        self.check(b"<!-- dependency-summary-fingerprint: 0123abcd -->\nline one\n", ["line one\n"])
+        self.check(b"[1,2]", [b"[1,", b"2]"], binary=True)
+
+    def test_mismatches(self):
+        for expected, chunks in ((b"line one\n", ["line two\n"]),
+                                 (b"line one\n", ["line one\n", "more\n"]),
+                                 (b"<!-- dependency-summary-fingerprint: 0123abcd -->\nline one\n",
+                                  ["line two\n"])):
+            with self.assertRaisesRegex(RuntimeError, "Dependency details have changed"):
+                self.check(expected, chunks)
+
+    def test_invalid_sidecar(self):
+        with open(self.path, "wb") as f:
+            f.write(b"line one\n")
+        for contents in ("", "\n", "not a digest  expected\n", "0123abcd  expected\n"):
+            self.write_sidecar(contents)
+            with self.assertRaisesRegex(RuntimeError, "Could not read a sha256 digest"):
+                dependency_summary.HashCompareWriter(self.path, self.sha256Path)
+
+
+class ParseArgsTests(unittest.TestCase):
+    # These follow the behaviour of the `argparse` parser that `parse_args` replaced.
+
+    def parse(self, *argv):
+        args = dependency_summary.parse_args(argv)
+        return (args.packages, args.targets, args.json, args.check)
+
+    def parse_error(self, *argv):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr), self.assertRaises(SystemExit) as cm:
+            dependency_summary.parse_args(argv)
+        self.assertEqual(cm.exception.code, 2, argv)
+        self.assertTrue(stderr.getvalue().startswith("usage: "), argv)
+        return stderr.getvalue().splitlines()[-1]
+
+    def test_defaults(self):
+        self.assertEqual(self.parse(), (None, None, False, None))
+
+    def test_packages(self):
+        for argv in (("-p", "foo"), ("-pfoo",), ("-p=foo",), ("--package", "foo"), ("--package=foo",),
+                     ("--pack", "foo"), ("--p=foo",)):
+            self.assertEqual(self.parse(*argv), (["foo"], None, False, None), argv)
+        self.assertEqual(self.parse("--package", "foo", "-p", "bar")[0], ["foo", "bar"])
+        self.assertEqual(self.parse("-p", "-")[0], ["-"])
+
+    def test_targets(self):
+        android = dependency_summary.ALL_ANDROID_TARGETS
+        ios = dependency_summary.ALL_IOS_TARGETS
+        self.assertEqual(self.parse("--target", "t")[1], ["t"])
+        self.assertEqual(self.parse("--target=-x")[1], ["-x"])
+        self.assertEqual(self.parse("--target=")[1], [""])
+        self.assertEqual(self.parse("--all-android-targets", "--target", "t")[1], android + ["t"])
+        self.assertEqual(self.parse("--target", "t", "--all-ios-targets")[1], ["t"] + ios)
+        self.assertEqual(self.parse("--all-a")[1], android)
+
+    def test_json_and_check(self):
+        self.assertEqual(self.parse("--json", "--json"), (None, None, True, None))
+        self.assertEqual(self.parse("--j"), (None, None, True, None))
+        self.assertEqual(self.parse("--check", "a", "--check", "b"), (None, None, False, "b"))
+        self.assertEqual(self.parse("--ch", "f"), (None, None, False, "f"))
+        self.assertEqual(self.parse("--check=--json"), (None, None, False, "--json"))
+        self.assertEqual(self.parse("--check", "-"), (None, None, False, "-"))
+
+    def test_help(self):
+        for argv in (("-h",), ("--help",), ("--he",), ("-p", "foo", "-h")):
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout), self.assertRaises(SystemExit) as cm:
+                dependency_summary.parse_args(argv)
+            self.assertEqual(cm.exception.code, 0, argv)
+            self.assertTrue(stdout.getvalue().startswith("usage: "), argv)
+
+    def test_missing_values(self):
+        for argv, option in ((("-p",), "-p/--package"), (("--target",), "--target"),
+                             (("--target", "-p"), "--target"), (("--check", "--json"), "--check"),
+                             (("-p", "--", "x"), "-p/--package"), (("--ch", "--pa", "x"), "--check")):
+            self.assertEqual(self.parse_error(*argv),
+                             "dependency_summary.py: error: argument {}: expected one argument".format(option))
+
+    def test_ambiguous_prefix(self):
+        self.assertEqual(self.parse_error("--all", "x"),
+                         "dependency_summary.py: error: ambiguous option: --all could match "
+                         "--all-android-targets, --all-ios-targets")
+
+    def test_explicit_argument_to_flag(self):
+        self.assertEqual(self.parse_error("--json=1"),
+                         "dependency_summary.py: error: argument --json: ignored explicit argument '1'")
+        self.assertEqual(self.parse_error("--all-ios-targets=x"),
+                         "dependency_summary.py: error: argument --all-ios-targets: ignored explicit argument 'x'")
+
+    def test_unrecognized_arguments(self):
+        for argv, unrecognized in ((("--bogus",), "--bogus"), (("foo",), "foo"), (("-x",), "-x"),
+                                   (("foo", "-p", "x", "bar"), "foo bar"), (("--", "x"), "-- x"),
+                                   (("--json", "--", "-p"), "-- -p")):
+            self.assertEqual(self.parse_error(*argv),
+                             "dependency_summary.py: error: unrecognized arguments: {}".format(unrecognized))
+
+
+if __name__ == "__main__":
+    unittest.main()